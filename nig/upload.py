@@ -1,19 +1,36 @@
 import json
+import mmap
+import os
+import random
 import re
+import ssl
 import tempfile
 import time
-import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache, partial
 from mimetypes import MimeTypes
 from pathlib import Path
-from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-import dateutil.parser
-import OpenSSL.crypto
-import pytz
 import requests
 import typer
+from requests.adapters import HTTPAdapter
+from urllib3.util.ssl_ import create_urllib3_context
 
 app = typer.Typer()
 
@@ -26,11 +43,77 @@ GB = 1_073_741_824
 MB = 1_048_576
 KB = 1024
 
+# values of the optional columns meaning that the value is missing
+NULL_VALUES = frozenset(("", "-", "N/A"))
+
+HPO_PATTERN = re.compile(r"HP:[0-9]+$")
+
+# dates parsed without dateutil
+ISO_DATE_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+# in the order they are listed in the error messages
+PLATFORMS = (
+    "Illumina",
+    "Ion",
+    "Pacific Biosciences",
+    "Roche 454",
+    "SOLiD",
+    "SNP-array",
+    "Other",
+)
+SUPPORTED_PLATFORMS = frozenset(PLATFORMS)
+
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 64
+# max number of concurrent requests
+MAX_WORKERS = 8
+# max upload chunk size in MB
+MAX_CHUNK_SIZE = 128
+# number of chunks read in advance during an upload
+READ_AHEAD = 2
+# min seconds between two updates of the upload progress bar
+PROGRESS_INTERVAL = 0.25
+
+# the mime types database is loaded once
+MIME_TYPES = MimeTypes()
+
+# HTTPS connections are kept alive and reused by all the requests
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE),
+)
+
+
+class ResponseException(Exception):
+    """Base exception for errors that can be related to a server response"""
+
+    def __init__(
+        self, error_message: str, r: Optional[requests.Response] = None
+    ) -> None:
+        self.error_message = error_message
+        self.r = r
+        super().__init__(error_message)
+
+    @property
+    def message(self) -> str:
+        return str(self)
+
+    def __str__(self) -> str:
+        # the response is only read when the error is reported
+        if self.r is None:
+            return self.error_message
+        return f"{self.error_message}. Code: {self.r.status_code}, response: {get_response(self.r)}"
+
 
 class RequestMethodError(Exception):
     """Exception for unknown request method"""
 
 
+class CertificateException(Exception):
+    """Exception for client certificates that can't be decrypted"""
+
+
 class PhenotypeMalformedException(Exception):
     """Exception for malformed pedigree files"""
 
@@ -51,15 +134,9 @@ class PhenotypeNameException(Exception):
     """Exception for phenotypes that have names not related to an existing dataset"""
 
 
-class RelationshipException(Exception):
+class RelationshipException(ResponseException):
     """Exception for a relationship between non existing phenotypes or generic errors in creating a relationship"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
-
 
 class GeodataException(Exception):
     """Exception for errors in geodata"""
@@ -77,178 +154,167 @@ class TechnicalAssociationException(Exception):
     """Exception for technicals with a non existing dataset associated"""
 
 
-class ResourceCreationException(Exception):
+class ResourceCreationException(ResponseException):
     """Exception for errors in creating resources"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
-
 
-class ResourceRetrievingException(Exception):
+class ResourceRetrievingException(ResponseException):
     """Exception for errors in retrieving resources"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
 
-
-class ResourceAssignationException(Exception):
+class ResourceAssignationException(ResponseException):
     """Exception for errors in assignating resources to other resources (ex. phenotypes to a dataset)"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
-
 
-class ResourceModificationException(Exception):
+class ResourceModificationException(ResponseException):
     """Exception for errors in modify resources"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
 
-
-class UploadInitException(Exception):
+class UploadInitException(ResponseException):
     """Exception for errors in initializing an upload"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
-
 
-class UploadException(Exception):
+class UploadException(ResponseException):
     """Exception for errors in uploading a file"""
 
-    def __init__(self, error_message, r=None):
-        self.message = error_message
-        if r is not None:
-            self.message += f". Code: {r.status_code}, response: {get_response(r)}"
-        super().__init__(self.message)
+
+class SSLContextAdapter(HTTPAdapter):
+    """HTTPAdapter using the same SSL context for all its connections"""
+
+    def __init__(self, ssl_context: ssl.SSLContext, **kwargs: Any) -> None:
+        # has to be set before HTTPAdapter.__init__ creates the pool manager
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args: Any, **kwargs: Any) -> Any:
+        kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
 
 
 @contextmanager
 def pfx_to_pem(pfx_path: Path, pfx_password: str) -> Generator[str, None, None]:
-    """Decrypts the .pfx file to be used with requests."""
-    with tempfile.NamedTemporaryFile(suffix=".pem") as t_pem:
-        f_pem = open(t_pem.name, "wb")
-        pfx = open(pfx_path, "rb").read()
+    """Decrypts the .pfx file to be loaded in an SSL context.
+
+    The PEM file is removed as soon as the context is exited.
+    """
+    import OpenSSL.crypto
+
+    pfx = Path(pfx_path).read_bytes()
+    try:
         p12 = OpenSSL.crypto.load_pkcs12(pfx, pfx_password.encode())
-        f_pem.write(
-            OpenSSL.crypto.dump_privatekey(
-                OpenSSL.crypto.FILETYPE_PEM, p12.get_privatekey()
-            )
-        )
-        f_pem.write(
-            OpenSSL.crypto.dump_certificate(
-                OpenSSL.crypto.FILETYPE_PEM, p12.get_certificate()
+    except OpenSSL.crypto.Error as exc:
+        raise CertificateException(f"can't decrypt the .pfx file ({exc})") from exc
+
+    f_pem = tempfile.NamedTemporaryFile(suffix=".pem", delete=False)
+    # the file is removed even if writing it fails
+    try:
+        with f_pem:
+            f_pem.write(
+                OpenSSL.crypto.dump_privatekey(
+                    OpenSSL.crypto.FILETYPE_PEM, p12.get_privatekey()
+                )
             )
-        )
-        ca = p12.get_ca_certificates()
-        if ca is not None:
-            for cert in ca:
-                f_pem.write(
-                    OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert)
+            f_pem.write(
+                OpenSSL.crypto.dump_certificate(
+                    OpenSSL.crypto.FILETYPE_PEM, p12.get_certificate()
                 )
-        f_pem.close()
-        yield t_pem.name
+            )
+            ca = p12.get_ca_certificates()
+            if ca is not None:
+                for cert in ca:
+                    f_pem.write(
+                        OpenSSL.crypto.dump_certificate(
+                            OpenSSL.crypto.FILETYPE_PEM, cert
+                        )
+                    )
+        yield f_pem.name
+    finally:
+        os.unlink(f_pem.name)
+
+
+def get_session(certfile: Path, certpwd: str) -> requests.Session:
+    """Returns a session authenticated with the client certificate.
+
+    The certificate is loaded once in an SSL context shared by all the
+    connections of the session.
+    """
+    ssl_context = create_urllib3_context()
+    # the decrypted key is only kept on disk while it is loaded
+    with pfx_to_pem(certfile, certpwd) as pem:
+        ssl_context.load_cert_chain(pem)
+    session = requests.Session()
+    session.mount(
+        "https://",
+        SSLContextAdapter(
+            ssl_context,
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+        ),
+    )
+    return session
 
 
 def request(
     method: str,
     url: str,
-    certfile: Path,
-    certpwd: str,
-    data: Union[bytes, Dict[str, Any]],
+    session: requests.Session,
+    data: Union[bytes, memoryview, Dict[str, Any]],
     headers: Optional[Dict[str, Any]] = None,
 ) -> requests.Response:
     MAX_RETRIES = 3
-    SLEEP_TIME = 10
+    BACKOFF_TIME = 2.5
+    MAX_SLEEP_TIME = 15
 
-    with pfx_to_pem(certfile, certpwd) as cert:
-        if method == POST:
-            for i in range(MAX_RETRIES):
-                try:
-                    r = requests.post(
-                        url,
-                        data=data,
-                        headers=headers,
-                        timeout=15,
-                        cert=cert,
-                    )
-                    return r
-                except Exception as e:
-                    error(f"The request raised the following error {e}")
-                    if i < MAX_RETRIES:
-                        debug(f"Retry n.{i + 1} will be done in {SLEEP_TIME} seconds")
-                    time.sleep(SLEEP_TIME)
-                    continue
+    if method not in (GET, POST, PUT, PATCH):
+        raise RequestMethodError(f"method {method} not allowed")
 
-        if method == PUT:
-            for i in range(MAX_RETRIES):
-                try:
-                    r = requests.put(
-                        url,
-                        data=data,
-                        headers=headers,
-                        timeout=15,
-                        cert=cert,
-                    )
-                    return r
-                except Exception as e:
-                    error(f"The request raised the following error {e}")
-                    if i < MAX_RETRIES:
-                        debug(f"Retry n.{i + 1} will be done in {SLEEP_TIME} seconds")
-                    time.sleep(SLEEP_TIME)
-                    continue
+    kwargs: Dict[str, Any] = {"headers": headers, "timeout": 15}
+    if method != GET:
+        kwargs["data"] = data
 
-        if method == PATCH:
-            for i in range(MAX_RETRIES):
-                try:
-                    r = requests.patch(
-                        url,
-                        data=data,
-                        headers=headers,
-                        timeout=15,
-                        cert=cert,
-                    )
-                    return r
-                except Exception as e:
-                    error(f"The request raised the following error {e}")
-                    if i < MAX_RETRIES:
-                        debug(f"Retry n.{i + 1} will be done in {SLEEP_TIME} seconds")
-                    time.sleep(SLEEP_TIME)
-                    continue
+    for i in range(MAX_RETRIES - 1):
+        try:
+            return session.request(method.upper(), url, **kwargs)
+        except requests.RequestException as e:
+            # requests that change data are only sent again after connection
+            # errors: after a timeout or a broken response the server may have
+            # already processed them, and a chunk or a resource would be duplicated
+            if method != GET and not isinstance(e, requests.ConnectionError):
+                raise
+            error(f"The request raised the following error {e}")
+            # exponential backoff with full jitter
+            sleep_time = random.uniform(
+                0, min(BACKOFF_TIME * 2 ** (i + 1), MAX_SLEEP_TIME)
+            )
+            debug(f"Retry n.{i + 1} will be done in {sleep_time:.1f} seconds")
+            time.sleep(sleep_time)
 
-        if method == GET:
-            for i in range(MAX_RETRIES):
-                try:
-                    r = requests.get(
-                        url,
-                        headers=headers,
-                        timeout=15,
-                        cert=cert,
-                    )
-                    return r
-                except Exception as e:
-                    error(f"The request raised the following error {e}")
-                    if i < MAX_RETRIES:
-                        debug(f"Retry n.{i + 1} will be done in {SLEEP_TIME} seconds")
-                    time.sleep(SLEEP_TIME)
-                    continue
+    # last attempt: errors are raised to the caller
+    return session.request(method.upper(), url, **kwargs)
+
+
+# request specialized for each method
+get = partial(request, GET)
+post = partial(request, POST)
+put = partial(request, PUT)
+patch = partial(request, PATCH)
 
-        # if hasn't returned yet is because the method is unknown
-        raise RequestMethodError(f"method {method} not allowed")
+
+def post_many(
+    requests_data: List[Tuple[str, Dict[str, Any]]],
+    session: requests.Session,
+) -> List[requests.Response]:
+    """Sends concurrent POST requests, responses are returned in the same order"""
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(post, url=url, session=session, data=data)
+            for url, data in requests_data
+        ]
+    return [future.result() for future in futures]
 
 
 def error(text: str, r: Optional[requests.Response] = None) -> None:
@@ -279,36 +345,56 @@ def get_response(r: requests.Response) -> Any:
     return r.json()
 
 
-def get_value(key: str, header: List[str], line: List[str]) -> Optional[str]:
-    if not header:
-        return None
-    if key not in header:
+def get_columns(header: List[str]) -> Dict[str, int]:
+    columns: Dict[str, int] = {}
+    for index, key in enumerate(header):
+        # keep the first occurrence of duplicated keys
+        columns.setdefault(key, index)
+    return columns
+
+
+def get_value(index: Optional[int], line: List[str]) -> Optional[str]:
+    if index is None:
         return None
-    index = header.index(key)
     if index >= len(line):
         return None
     value = line[index]
-    if not value:
-        return None
-    if value == "-":
-        return None
-    if value == "N/A":
+    if value in NULL_VALUES:
         return None
     return value
 
 
+@lru_cache(maxsize=1024)
 def date_from_string(date: str, fmt: str = "%d/%m/%Y") -> Optional[datetime]:
 
     if date == "":
         return None
+    return_date: Optional[datetime] = None
     # datetime.now(pytz.utc)
-    try:
-        return_date = datetime.strptime(date, fmt)
-    except BaseException:
+    # dates that can't be in the default dd/mm/yyyy format go straight to dateutil
+    if fmt != "%d/%m/%Y" or "/" in date:
+        try:
+            return_date = datetime.strptime(date, fmt)
+        except ValueError:
+            pass
+
+    # plain yyyy-mm-dd dates don't need the slower dateutil parser, other
+    # formats accepted by fromisoformat depend on the python version
+    if return_date is None and ISO_DATE_PATTERN.fullmatch(date):
+        try:
+            return_date = datetime.fromisoformat(date)
+        except ValueError:
+            pass
+
+    if return_date is None:
+        import dateutil.parser
+
         return_date = dateutil.parser.parse(date)
 
     # TODO: test me with: 2017-09-22T07:10:35.822772835Z
     if return_date.tzinfo is None:
+        import pytz
+
         return pytz.utc.localize(return_date)
 
     return return_date
@@ -317,27 +403,30 @@ def date_from_string(date: str, fmt: str = "%d/%m/%Y") -> Optional[datetime]:
 def parse_file_ped(
     file: Path, datasets: Dict[str, List[Path]]
 ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, List[str]]]]:
-    with open(file) as f:
+    with open(file, buffering=MB) as f:
 
-        header: List[str] = []
-        phenotype_list: List[str] = []
+        # indexes of the optional columns, resolved when the header is read
+        age_index: Optional[int] = None
+        birth_place_index: Optional[int] = None
+        hpo_index: Optional[int] = None
+        phenotype_list: Set[str] = set()
         phenotypes: List[Dict[str, Any]] = []
         relationships: Optional[Dict[str, List[str]]] = {}
-        while True:
-            row = f.readline()
-            if not row:
-                break
+        for row in f:
 
             if row.startswith("#"):
                 # Remove the initial #
                 row = row[1:].strip().lower()
                 # header = re.split(r"\s+|\t", line)
-                header = re.split(r"\t", row)
+                columns = get_columns(row.split("\t"))
+                age_index = columns.get("age")
+                birth_place_index = columns.get("birthplace")
+                hpo_index = columns.get("hpo")
                 continue
 
             row = row.strip()
             # line = re.split(r"\s+|\t", line)
-            line = re.split(r"\t", row)
+            line = row.split("\t")
 
             if len(line) < 5:
                 raise PhenotypeMalformedException(
@@ -347,7 +436,7 @@ def parse_file_ped(
             # pedigree_id = line[0]
             individual_id = line[1]
             # validate phenotypes: check if they are associated to an existing dataset
-            if individual_id not in datasets.keys():
+            if individual_id not in datasets:
                 # phenotype has to have the same name of the dataset to be associated
                 raise PhenotypeNameException(
                     f"Phenotype {individual_id} is not related to any existing dataset"
@@ -365,11 +454,9 @@ def parse_file_ped(
                     f"Can't parse {sex} sex for {individual_id}: Please use M F notation"
                 )
 
-            properties = {}
-            properties["name"] = individual_id
-            properties["sex"] = sex
+            properties: Dict[str, Any] = {"name": individual_id, "sex": sex}
 
-            age = get_value("age", header, line)
+            age = get_value(age_index, line)
             if age is not None:
                 if int(age) < 0:
                     raise AgeException(
@@ -377,22 +464,22 @@ def parse_file_ped(
                     )
                 properties["age"] = int(age)
 
-            birth_place = get_value("birthplace", header, line)
+            birth_place = get_value(birth_place_index, line)
             if birth_place is not None and birth_place != "-":
                 properties["birth_place_name"] = birth_place
 
-            hpo = get_value("hpo", header, line)
+            hpo = get_value(hpo_index, line)
             if hpo is not None:
                 hpo_list = hpo.split(",")
                 for hpo_el in hpo_list:
-                    if not re.match(r"HP:[0-9]+$", hpo_el):
+                    if not HPO_PATTERN.match(hpo_el):
                         raise HPOException(
                             f"Error parsing phenotype {individual_id}: {hpo_el} is an invalid HPO"
                         )
-                properties["hpo"] = json.dumps(hpo_list)
+                properties["hpo"] = json.dumps(hpo_list, separators=(",", ":"))
 
             phenotypes.append(properties)
-            phenotype_list.append(individual_id)
+            phenotype_list.add(individual_id)
 
             # parse relationships
             relationships[individual_id] = []
@@ -409,12 +496,18 @@ def parse_file_ped(
 
     # check if relationships are valid
     if relationships:
-        for son, family in relationships.items():
-            for parent in family:
-                if parent not in phenotype_list:
-                    raise RelationshipException(
-                        f"Error in relationship between {son} and {parent}: Phenotype {parent} does not exist"
-                    )
+        parents = {parent for family in relationships.values() for parent in family}
+        if not parents <= phenotype_list:
+            # report the first relationship with an unknown parent
+            son, parent = next(
+                (son, parent)
+                for son, family in relationships.items()
+                for parent in family
+                if parent not in phenotype_list
+            )
+            raise RelationshipException(
+                f"Error in relationship between {son} and {parent}: Phenotype {parent} does not exist"
+            )
 
     return phenotypes, relationships
 
@@ -422,36 +515,23 @@ def parse_file_ped(
 def parse_file_tech(
     file: Path, datasets: Dict[str, List[Path]]
 ) -> List[Dict[str, Any]]:
+    with open(file, buffering=MB) as f:
 
-    supported_platforms = [
-        "Illumina",
-        "Ion",
-        "Pacific Biosciences",
-        "Roche 454",
-        "SOLiD",
-        "SNP-array",
-        "Other",
-    ]
-
-    with open(file) as f:
-
-        header: List[str] = []
+        # index of the optional dataset column, resolved when the header is read
+        dataset_index: Optional[int] = None
         technicals: List[Dict[str, Any]] = []
-        while True:
-            row = f.readline()
-            if not row:
-                break
+        for row in f:
 
             if row.startswith("#"):
                 # Remove the initial #
                 row = row[1:].strip().lower()
                 # header = re.split(r"\s+|\t", row)
-                header = re.split(r"\t", row)
+                dataset_index = get_columns(row.split("\t")).get("dataset")
                 continue
 
             row = row.strip()
             # line = re.split(r"\s+|\t", row)
-            line = re.split(r"\t", row)
+            line = row.split("\t")
 
             if len(line) < 4:
                 raise TechnicalMalformedException(
@@ -463,27 +543,29 @@ def parse_file_tech(
             platform = line[2]
             kit = line[3]
 
-            technical = {}
-            properties = {}
-            properties["name"] = name
             if date and date != "-":
-                properties["sequencing_date"] = date_from_string(date).date()
+                sequencing_date = date_from_string(date).date()
             else:
-                properties["sequencing_date"] = ""
+                sequencing_date = ""
 
-            if platform and platform not in supported_platforms:
+            if platform and platform not in SUPPORTED_PLATFORMS:
                 raise UnknownPlatformException(
-                    f"Error for {name} technical: Platform has to be one of {supported_platforms}"
+                    f"Error for {name} technical: Platform has to be one of {list(PLATFORMS)}"
                 )
-            properties["platform"] = platform
-            properties["enrichment_kit"] = kit
-            technical["properties"] = properties
+            technical: Dict[str, Any] = {
+                "properties": {
+                    "name": name,
+                    "sequencing_date": sequencing_date,
+                    "platform": platform,
+                    "enrichment_kit": kit,
+                }
+            }
 
-            value = get_value("dataset", header, line)
+            value = get_value(dataset_index, line)
             if value is not None and value != "-":
                 dataset_list = value.split(",")
                 for dataset_name in dataset_list:
-                    if dataset_name not in datasets.keys():
+                    if dataset_name not in datasets:
                         raise TechnicalAssociationException(
                             f"Error for {name} technical: associated dataset {dataset_name} does not exist"
                         )
@@ -491,9 +573,9 @@ def parse_file_tech(
             technicals.append(technical)
     # check dataset association for technicals
     if len(technicals) > 1:
-        associated_datasets = []
+        associated_datasets: Set[str] = set()
         for tech in technicals:
-            if "datasets" not in tech.keys():
+            if "datasets" not in tech:
                 raise TechnicalAssociationException(
                     f"Technical {tech['properties']['name']} is not associated to any dataset"
                 )
@@ -502,7 +584,7 @@ def parse_file_tech(
                     raise TechnicalAssociationException(
                         f"Dataset {d} has multiple technicals associated"
                     )
-                associated_datasets.append(d)
+                associated_datasets.add(d)
 
     return technicals
 
@@ -513,16 +595,21 @@ def version_callback(value: bool) -> None:
         raise typer.Exit()
 
 
-def pluralize(value: int, unit: str) -> str:
+def pluralize(value: float, unit: str) -> str:
     if value == 1:
         return f"{value} {unit}"
     return f"{value} {unit}s"
 
 
 # from restapi.utilities.time
-def get_time(seconds: int) -> str:
+def get_time(seconds: float) -> str:
 
     elements: List[str] = []
+    if seconds < 1:
+        elements.append(pluralize(round(seconds, 2), "second"))
+        return ", ".join(elements)
+
+    seconds = int(seconds)
     if seconds < 60:
         elements.append(pluralize(seconds, "second"))
 
@@ -574,7 +661,9 @@ def get_speed(value: float) -> str:
 
 
 def get_ip() -> str:
-    return urllib.request.urlopen("https://ident.me").read().decode("utf8")
+    r = SESSION.get("https://ident.me", timeout=5)
+    r.raise_for_status()
+    return r.text.strip()
 
 
 def validate_study(study: Path) -> Optional[Dict[str, Any]]:
@@ -586,33 +675,33 @@ def validate_study(study: Path) -> Optional[Dict[str, Any]]:
         "datasets": {},
     }
 
-    for d in study.iterdir():
-        if d.is_dir():
-            for dat in d.iterdir():
+    # DirEntry caches the file type and stat results of the entries
+    with os.scandir(study) as study_entries:
+        for d in study_entries:
+            if d.is_dir():
+                with os.scandir(d.path) as dataset_entries:
+                    for dat in dataset_entries:
+                        is_fastq = dat.name.endswith(".fastq.gz")
+                        if dat.is_file() and is_fastq and dat.stat().st_size >= 1:
+                            study_tree["datasets"].setdefault(d.name, [])
+                            study_tree["datasets"][d.name].append(Path(dat.path))
+                        else:
+                            warning(f"File {dat.path} skipped")
+                            debug(
+                                f"DEBUG : skipped because is not a file? { not dat.is_file()}, skipped because is empty? {dat.stat().st_size < 1}, has the correct file extension (.fastq.gz)? {is_fastq}"
+                            )
                 if (
-                    dat.is_file()
-                    and dat.name.endswith(".fastq.gz")
-                    and dat.stat().st_size >= 1
+                    study_tree["datasets"].get(d.name)
+                    and len(study_tree["datasets"][d.name]) > 2
                 ):
-                    study_tree["datasets"].setdefault(d.name, [])
-                    study_tree["datasets"][d.name].append(dat)
-                else:
-                    warning(f"File {dat} skipped")
-                    debug(
-                        f"DEBUG : skipped because is not a file? { not dat.is_file()}, skipped because is empty? {dat.stat().st_size < 1}, has the correct file extension (.fastq.gz)? {dat.name.endswith('.fastq.gz')}"
+                    # the dataset is invalid because contains too many fastq
+                    warning(
+                        f"Upload of {study.name} skipped: Dataset {d.name} contains too many fastq files: max allowed files are 2 per dataset"
                     )
-            if (
-                study_tree["datasets"].get(d.name)
-                and len(study_tree["datasets"][d.name]) > 2
-            ):
-                # the dataset is invalid because contains too many fastq
-                warning(
-                    f"Upload of {study.name} skipped: Dataset {d.name} contains too many fastq files: max allowed files are 2 per dataset"
-                )
-                return None
-        else:
-            if d.name != "technical.txt" and d.name != "pedigree.txt":
-                warning(f"{d} is not a directory")
+                    return None
+            else:
+                if d.name != "technical.txt" and d.name != "pedigree.txt":
+                    warning(f"{d.path} is not a directory")
 
     if not study_tree["datasets"]:
         warning(
@@ -657,43 +746,195 @@ def validate_study(study: Path) -> Optional[Dict[str, Any]]:
     return study_tree
 
 
-def get_technical_uuid(
-    study_tree: Dict[str, Any], dataset_name: str, technicals_uuid: Dict[str, str]
-) -> Optional[str]:
-    tech_uuid: Optional[str] = None
-    if len(study_tree["technicals"]) > 1:
-        for tech in study_tree["technicals"]:
-            if dataset_name in tech["datasets"]:
-                tech_uuid = technicals_uuid[tech["properties"]["name"]]
-                break
-    else:
-        if (
-            "datasets" not in study_tree["technicals"][0].keys()
-            or "datasets" in study_tree["technicals"][0].keys()
-            and dataset_name in study_tree["technicals"][0]["datasets"]
-        ):
-            tech_uuid = technicals_uuid[
-                study_tree["technicals"][0]["properties"]["name"]
-            ]
-    return tech_uuid
+def get_existing_datasets(
+    url: str,
+    study_uuid: str,
+    session: requests.Session,
+) -> Set[str]:
+    r = get(
+        url=f"{url}api/study/{study_uuid}/datasets",
+        session=session,
+        data={},
+    )
+    if r.status_code != 200:
+        raise ResourceRetrievingException("Can't retrieve user's datasets list", r)
+
+    return {el["name"] for el in r.json() or []}
+
+
+def read_chunks(f: BinaryIO, size: int) -> Iterator[memoryview]:
+    """Reads a file by chunks, the next chunks are read while the current is used"""
+    # one buffer for the chunk in use and one for each chunk read in advance
+    buffers = deque(memoryview(bytearray(size)) for _ in range(READ_AHEAD + 1))
+
+    def read_into(buffer: memoryview) -> memoryview:
+        return buffer[: f.readinto(buffer)]
+
+    # a single worker reads the chunks in the order they are requested
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_chunks = deque(
+            executor.submit(read_into, buffers[i]) for i in range(READ_AHEAD)
+        )
+        buffers.rotate(-READ_AHEAD)
+        while True:
+            data = next_chunks.popleft().result()
+            # No more data read from the file
+            if not data:
+                return
+            # the buffer of the previous chunk is no longer used
+            next_chunks.append(executor.submit(read_into, buffers[0]))
+            buffers.rotate(-1)
+            yield data
+
+
+def map_chunks(f: BinaryIO, size: int) -> Iterator[memoryview]:
+    """Reads a file by chunks from a memory map, without copying them"""
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # empty files and files that can't be mapped are read in the usual way
+        yield from read_chunks(f, size)
+        return
+    with mm, memoryview(mm) as view:
+        for start in range(0, len(view), size):
+            if hasattr(mm, "madvise"):
+                # let the kernel read the next chunk while the current is sent
+                page_start = start - start % mmap.PAGESIZE
+                mm.madvise(
+                    mmap.MADV_WILLNEED, page_start, start + 2 * size - page_start
+                )
+            # the chunk is released before the map is closed
+            with view[start : start + size] as data:
+                yield data
+
+
+def get_upload_data(file: Path) -> Dict[str, Any]:
+    """Returns the data of the request that initializes the upload of a file"""
+    stat = file.stat()
+    return {
+        "name": file.name,
+        "mimeType": MIME_TYPES.guess_type(file.name),
+        "size": stat.st_size,
+        "lastModified": int(stat.st_mtime),
+    }
+
+
+def upload_file(
+    file: Path,
+    filesize: int,
+    upload_url: str,
+    session: requests.Session,
+    chunk_size: int,
+    IP_ADDR: str,
+    update_progress: Callable[[int], None],
+) -> bool:
+    """Uploads a file whose upload has already been initialized.
+
+    Returns False if the upload has been aborted.
+    """
+    # chunks refused by an unavailable server or that couldn't reach it are
+    # sent again a few times, not on gateway or read timeouts: the server may
+    # have already appended the chunk
+    RETRY_STATUSES = (502, 503)
+    MAX_RETRIES = 5
+    BACKOFF_TIME = 2.5
+    MAX_SLEEP_TIME = 60
+
+    filename = file.name
+
+    chunk = chunk_size * 1024 * 1024
+    chunks_url = f"{upload_url}/{filename}"
+    # position of the first byte of the chunk being sent
+    offset = 0
+    # bytes sent since the progress bar was last updated
+    not_shown = 0
+    # response to the last chunk, None if the file was empty
+    r: Optional[requests.Response] = None
+
+    with open(file, "rb") as f:
+        last_shown = time.monotonic()
+        for read_data in map_chunks(f, chunk):
+            n = len(read_data)
+
+            # the range end is exclusive: the last chunk ends at filesize
+            chunk_headers = {"Content-Range": f"bytes {offset}-{offset + n}/{filesize}"}
+
+            retries = 0
+            while True:
+                try:
+
+                    r = put(
+                        url=chunks_url,
+                        headers=chunk_headers,
+                        session=session,
+                        data=read_data,
+                    )
+                    if r.status_code not in RETRY_STATUSES or retries >= MAX_RETRIES:
+                        break
+                    reason = f"status {r.status_code}"
+                except requests.exceptions.ConnectionError as exc:
+
+                    IP = get_ip()
+                    if IP != IP_ADDR:
+                        error(
+                            f"\nUpload failed due to a network error ({exc})"
+                            f"\nYour IP address changed from {IP_ADDR} to {IP}."
+                            "\nDue to security policies the upload"
+                            " can't be retried"
+                        )
+                        return False
+                    if retries >= MAX_RETRIES:
+                        raise UploadException(
+                            f"Upload of {filename} failed due to a network error ({exc})"
+                        ) from exc
+                    reason = str(exc)
+
+                # the chunk is still in memory: send it again
+                retries += 1
+                # exponential backoff with full jitter
+                sleep_time = random.uniform(
+                    0, min(BACKOFF_TIME * 2**retries, MAX_SLEEP_TIME)
+                )
+                error(
+                    f"Upload Failed ({reason}), "
+                    f"retry n.{retries} in {sleep_time:.1f} seconds"
+                )
+                time.sleep(sleep_time)
+
+            if r.status_code != 206:
+                if r.status_code == 200:
+                    # upload is complete
+                    update_progress(not_shown + n)
+                    break
+                raise UploadException(f"Upload of {filename} failed", r)
+
+            offset += n
+            not_shown += n
+            # the progress bar is redrawn at most every PROGRESS_INTERVAL seconds
+            if time.monotonic() - last_shown >= PROGRESS_INTERVAL:
+                update_progress(not_shown)
+                not_shown = 0
+                last_shown = time.monotonic()
+
+    if r is None:
+        raise UploadException(f"Upload of {filename} failed: the file is empty")
+    if r.status_code != 200:
+        raise UploadException(f"Upload of {filename} failed", r)
+
+    return True
 
 
 def upload_study(
     study_tree: Dict[str, Any],
     url: str,
-    headers: Dict[str, str],
-    certfile: Path,
-    certpwd: str,
+    session: requests.Session,
     chunk_size: int,
     IP_ADDR: str,
 ) -> None:
     study_name = study_tree["name"]
-    r = request(
-        method=POST,
+    r = post(
         url=f"{url}api/study",
-        headers=headers,
-        certfile=certfile,
-        certpwd=certpwd,
+        session=session,
         data={"name": study_name, "description": ""},
     )
     if r.status_code != 200:
@@ -707,46 +948,43 @@ def upload_study(
     phenotypes_uuid: Dict[str, str] = {}
     if study_tree["phenotypes"]:
         # get geodata list
-        headers["Content-Type"] = "application/json"
-        r = request(
-            method=POST,
+        r = post(
             url=f"{url}api/study/{study_uuid}/phenotypes",
-            headers=headers,
-            certfile=certfile,
-            certpwd=certpwd,
+            headers={"Content-Type": "application/json"},
+            session=session,
             data='{"get_schema": true}',
         )
         if r.status_code != 200:
             raise ResourceRetrievingException("Can't retrieve geodata list", r)
 
-        for el in r.json():
-            if el["key"] == "birth_place":
-                geodata = el["options"]
-                break
+        geodata: Dict[str, str] = next(
+            (el["options"] for el in r.json() if el["key"] == "birth_place"), {}
+        )
+        # map the place names to their ids, keeping the first id of each name
+        geo_ids: Dict[str, str] = {}
+        for geo_id, name in geodata.items():
+            geo_ids.setdefault(name, geo_id)
         for phenotype in study_tree["phenotypes"]:
             # get the birth_place
             if phenotype.get("birth_place_name"):
-                for geo_id, name in geodata.items():
-                    if name == phenotype["birth_place_name"]:
-                        phenotype["birth_place"] = geo_id
-                        break
-                if "birth_place" not in phenotype.keys():
+                geo_id = geo_ids.get(phenotype["birth_place_name"])
+                if geo_id is None:
                     raise GeodataException(
                         f"Error for phenotype {phenotype['name']}: {phenotype['birth_place_name']} birth place not found"
                     )
+                phenotype["birth_place"] = geo_id
 
                 # delete birth_place_name key
                 del phenotype["birth_place_name"]
 
-            headers.pop("Content-Type", None)
-            r = request(
-                method=POST,
-                url=f"{url}api/study/{study_uuid}/phenotypes",
-                headers=headers,
-                certfile=certfile,
-                certpwd=certpwd,
-                data=phenotype,
-            )
+        responses = post_many(
+            [
+                (f"{url}api/study/{study_uuid}/phenotypes", phenotype)
+                for phenotype in study_tree["phenotypes"]
+            ],
+            session,
+        )
+        for phenotype, r in zip(study_tree["phenotypes"], responses):
             if r.status_code != 200:
                 raise ResourceCreationException("Phenotype creation failed", r)
 
@@ -756,36 +994,39 @@ def upload_study(
             phenotypes_uuid[phenotype["name"]] = r.json()
 
     # create phenotypes relationships
-    if "relationships" in study_tree.keys():
-        for son, parent_list in study_tree["relationships"].items():
-            son_uuid = phenotypes_uuid.get(son)
-            for parent in parent_list:
-                parent_uuid = phenotypes_uuid.get(parent)
-                r = request(
-                    method=POST,
-                    url=f"{url}api/phenotype/{son_uuid}/relationships/{parent_uuid}",
-                    headers=headers,
-                    certfile=certfile,
-                    certpwd=certpwd,
-                    data={},
+    if "relationships" in study_tree:
+        relationships = [
+            (son, parent)
+            for son, parent_list in study_tree["relationships"].items()
+            for parent in parent_list
+        ]
+        responses = post_many(
+            [
+                (
+                    f"{url}api/phenotype/{phenotypes_uuid[son]}/relationships/{phenotypes_uuid[parent]}",
+                    {},
                 )
-                if r.status_code != 200:
-                    raise RelationshipException("Phenotype relationship failed", r)
+                for son, parent in relationships
+            ],
+            session,
+        )
+        for (son, parent), r in zip(relationships, responses):
+            if r.status_code != 200:
+                raise RelationshipException("Phenotype relationship failed", r)
 
-                success(f"Succesfully created relationship between {son} and {parent}")
+            success(f"Succesfully created relationship between {son} and {parent}")
 
     # create technicals
     technicals_uuid: Dict[str, str] = {}
     if study_tree["technicals"]:
-        for technical in study_tree["technicals"]:
-            r = request(
-                method=POST,
-                url=f"{url}api/study/{study_uuid}/technicals",
-                headers=headers,
-                certfile=certfile,
-                certpwd=certpwd,
-                data=technical["properties"],
-            )
+        responses = post_many(
+            [
+                (f"{url}api/study/{study_uuid}/technicals", technical["properties"])
+                for technical in study_tree["technicals"]
+            ],
+            session,
+        )
+        for technical, r in zip(study_tree["technicals"], responses):
             if r.status_code != 200:
                 raise ResourceCreationException("Technical creation failed", r)
 
@@ -794,13 +1035,18 @@ def upload_study(
             # add the uuid in the technical uuid dictionary
             technicals_uuid[technical["properties"]["name"]] = r.json()
 
+    # map each dataset to the uuid of its technical:
+    # a technical without datasets is associated to all of them
+    datasets_technicals: Dict[str, str] = {
+        dataset_name: technicals_uuid[technical["properties"]["name"]]
+        for technical in study_tree["technicals"] or []
+        for dataset_name in technical.get("datasets", study_tree["datasets"])
+    }
+
     for dataset_name, files in study_tree["datasets"].items():
-        r = request(
-            method=POST,
+        r = post(
             url=f"{url}api/study/{study_uuid}/datasets",
-            headers=headers,
-            certfile=certfile,
-            certpwd=certpwd,
+            session=session,
             data={"name": dataset_name, "description": ""},
         )
 
@@ -809,16 +1055,14 @@ def upload_study(
 
         success(f"Succesfully created dataset {dataset_name}")
         uuid = r.json()
+        dataset_url = f"{url}api/dataset/{uuid}"
 
         #  connect the phenotype to the dataset
-        if dataset_name in phenotypes_uuid.keys():
+        if dataset_name in phenotypes_uuid:
             phen_uuid = phenotypes_uuid[dataset_name]
-            r = request(
-                method=PUT,
-                url=f"{url}api/dataset/{uuid}",
-                headers=headers,
-                certfile=certfile,
-                certpwd=certpwd,
+            r = put(
+                url=dataset_url,
+                session=session,
                 data={"phenotype": phen_uuid},
             )
             if r.status_code != 204:
@@ -829,133 +1073,59 @@ def upload_study(
             success(f"Succesfully assigned phenotype to dataset {dataset_name}")
 
         #  connect the technical to the dataset
-        if study_tree["technicals"]:
-            tech_uuid = get_technical_uuid(study_tree, dataset_name, technicals_uuid)
-
-            if tech_uuid:
-                r = request(
-                    method=PUT,
-                    url=f"{url}api/dataset/{uuid}",
-                    headers=headers,
-                    certfile=certfile,
-                    certpwd=certpwd,
-                    data={"technical": tech_uuid},
+        if dataset_name in datasets_technicals:
+            r = put(
+                url=dataset_url,
+                session=session,
+                data={"technical": datasets_technicals[dataset_name]},
+            )
+            if r.status_code != 204:
+                raise ResourceAssignationException(
+                    "Can't assign a technical to the dataset", r
                 )
-                if r.status_code != 204:
-                    raise ResourceAssignationException(
-                        "Can't assign a technical to the dataset", r
-                    )
 
-                success(f"Succesfully assigned technical to dataset {dataset_name}")
-
-        for file in files:
-            # get the data for the upload request
-            filename = file.name
-            filesize = file.stat().st_size
-            mimeType = MimeTypes().guess_type(str(file))
-            lastModified = int(file.stat().st_mtime)
-
-            data = {
-                "name": filename,
-                "mimeType": mimeType,
-                "size": filesize,
-                "lastModified": lastModified,
-            }
-
-            # init the upload
-            r = request(
-                method=POST,
-                url=f"{url}api/dataset/{uuid}/files/upload",
-                headers=headers,
-                certfile=certfile,
-                certpwd=certpwd,
-                data=data,
-            )
+            success(f"Succesfully assigned technical to dataset {dataset_name}")
 
+        # init the uploads of all the files of the dataset
+        upload_url = f"{dataset_url}/files/upload"
+        uploads_data = [get_upload_data(file) for file in files]
+        responses = post_many(
+            [(upload_url, data) for data in uploads_data],
+            session,
+        )
+        for file, r in zip(files, responses):
             if r.status_code != 201:
-                raise UploadInitException("Can't start the upload", r)
-
-            success("Upload succesfully initialized")
-
-            chunk = chunk_size * 1024 * 1024
-            range_start = -1
-            prev_position = 0
-
-            with open(file, "rb") as f:
-                start = datetime.now()
-                with typer.progressbar(length=filesize, label="Uploading") as progress:
-                    while True:
-
-                        prev_position = f.tell()
-                        read_data = f.read(chunk)
-                        # No more data read from the file
-                        if not read_data:
-                            break
-
-                        range_start += 1
-
-                        range_max = min(range_start + chunk, filesize)
-
-                        content_range = f"bytes {range_start}-{range_max}/{filesize}"
-                        headers["Content-Range"] = content_range
-
-                        try:
+                raise UploadInitException(f"Can't start the upload of {file.name}", r)
+
+        success(f"Upload succesfully initialized for dataset {dataset_name}")
+
+        # the files of the dataset share a progress bar
+        total_size = sum(data["size"] for data in uploads_data)
+        start = time.monotonic()
+        with typer.progressbar(
+            length=total_size, label=f"Uploading {dataset_name}"
+        ) as progress:
+            for file, data in zip(files, uploads_data):
+                if not upload_file(
+                    file,
+                    data["size"],
+                    upload_url,
+                    session,
+                    chunk_size,
+                    IP_ADDR,
+                    progress.update,
+                ):
+                    return None
+        seconds = max(time.monotonic() - start, 0.001)
 
-                            r = request(
-                                method=PUT,
-                                url=f"{url}api/dataset/{uuid}/files/upload/{filename}",
-                                headers=headers,
-                                certfile=certfile,
-                                certpwd=certpwd,
-                                data=read_data,
-                            )
-                        except (
-                            requests.exceptions.ConnectionError,
-                            requests.exceptions.ReadTimeout,
-                        ) as r:
-
-                            IP = get_ip()
-                            if IP != IP_ADDR:
-                                return error(
-                                    f"\nUpload failed due to a network error ({r})"
-                                    f"\nYour IP address changed from {IP_ADDR} to {IP}."
-                                    "\nDue to security policies the upload"
-                                    " can't be retried"
-                                )
-                            else:
-                                error(f"Upload Failed, retrying ({str(r)})")
-                                f.seek(prev_position)
-                                range_start -= 1
-                                continue
-
-                        if r.status_code != 206:
-                            if r.status_code == 200:
-                                # upload is complete
-                                progress.update(filesize)
-                                break
-                            raise UploadException("Upload Failed", r)
-
-                        progress.update(chunk)
-                        # update the range variable
-                        range_start += chunk
-
-                end = datetime.now()
-                seconds = (end - start).seconds or 1
-
-                t = get_time(seconds)
-                s = get_speed(filesize / seconds)
-                if r.status_code != 200:
-                    raise UploadException(f"Upload Failed in {t} ({s})", r)
-
-                success(f"Upload succesfully completed in {t} ({s})")
+        t = get_time(seconds)
+        s = get_speed(total_size / seconds)
+        success(f"Dataset {dataset_name} succesfully uploaded in {t} ({s})")
 
         # set the status of the dataset as "UPLOAD COMPLETED"
-        r = request(
-            method=PATCH,
-            url=f"{url}api/dataset/{uuid}",
-            headers=headers,
-            certfile=certfile,
-            certpwd=certpwd,
+        r = patch(
+            url=dataset_url,
+            session=session,
             data={"status": "UPLOAD COMPLETED"},
         )
         if r.status_code != 204:
@@ -1010,19 +1180,25 @@ def upload(
     if not certfile.exists():
         return error(f"Certificate not found: {certfile}")
 
-    if chunk_size > 16:
+    if chunk_size > MAX_CHUNK_SIZE:
         return error(f"The specified chunk size is too large: {chunk_size}")
+    if chunk_size < 1:
+        return error(f"The specified chunk size is too small: {chunk_size}")
+
+    # the certificate is loaded once and checked before contacting the server
+    try:
+        session = get_session(certfile, certpwd)
+    except (CertificateException, ssl.SSLError, ValueError) as exc:
+        return error(f"Can't load the certificate {certfile}: {exc}")
 
     try:
         IP_ADDR = get_ip()
         success(f"Your IP address is {IP_ADDR}")
 
         # Do login
-        r = request(
-            method=POST,
+        r = post(
             url=f"{url}auth/login",
-            certfile=certfile,
-            certpwd=certpwd,
+            session=session,
             data={"username": username, "password": pwd, "totp_code": totp},
         )
 
@@ -1034,10 +1210,11 @@ def upload(
             return error("Login Failed", r)
 
         token = r.json()
-        headers = {"Authorization": f"Bearer {token}"}
+        # the token is sent with all the following requests of the session
+        session.headers["Authorization"] = f"Bearer {token}"
         success("Succesfully logged in")
 
-    except RequestMethodError as exc:
+    except (RequestMethodError, requests.RequestException) as exc:
         return error(exc)
 
     # get a list of the path to the studies to upload
@@ -1053,60 +1230,53 @@ def upload(
             return error(
                 f"The specified directory containing the studies directories does not exists: {studies}"
             )
-        for d in studies.iterdir():
-            if d.is_dir():
-                studies_to_upload.append(d)
+        with os.scandir(studies) as entries:
+            for d in entries:
+                if d.is_dir():
+                    studies_to_upload.append(Path(d.path))
         if not studies_to_upload:
             return error(f"No studies found in {studies}")
 
     try:
         # get user studies list
-        existing_studies: Dict[str, str] = {}
-        r = request(
-            method=GET,
+        r = get(
             url=f"{url}api/study",
-            headers=headers,
-            certfile=certfile,
-            certpwd=certpwd,
+            session=session,
             data={},
         )
         if r.status_code != 200:
             raise ResourceRetrievingException("Can't retrieve user's studies list", r)
 
-        res = r.json()
-        if res:
-            for el in res:
-                existing_studies[el["name"]] = el["uuid"]
+        existing_studies: Dict[str, str] = {
+            el["name"]: el["uuid"] for el in r.json() or []
+        }
+
+        # get the datasets lists of the already existing studies concurrently
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            datasets_futures = {
+                s.name: executor.submit(
+                    get_existing_datasets,
+                    url,
+                    existing_studies[s.name],
+                    session,
+                )
+                for s in studies_to_upload
+                if s.name in existing_studies
+            }
 
         for s in studies_to_upload:
             # check if the study already exists
-            if s.name in existing_studies.keys():
+            if s.name in existing_studies:
                 # get the list of the datasets in the study to upload
-                datasets_to_upload: List[str] = []
-                for d in s.iterdir():
-                    if d.is_dir():
-                        datasets_to_upload.append(d.name)
+                datasets_to_upload: Set[str] = set()
+                with os.scandir(s) as entries:
+                    for d in entries:
+                        if d.is_dir():
+                            datasets_to_upload.add(d.name)
                 # get the list of the datasets of the existing study
-                existing_datasets: List[str] = []
-                r = request(
-                    method=GET,
-                    url=f"{url}api/study/{existing_studies[s.name]}/datasets",
-                    headers=headers,
-                    certfile=certfile,
-                    certpwd=certpwd,
-                    data={},
-                )
-                if r.status_code != 200:
-                    raise ResourceRetrievingException(
-                        "Can't retrieve user's datasets list", r
-                    )
-
-                res = r.json()
-                if res:
-                    for el in res:
-                        existing_datasets.append(el["name"])
-                # if the two list differs throw an error
-                if not set(datasets_to_upload) == set(existing_datasets):
+                existing_datasets = datasets_futures[s.name].result()
+                # if the two sets differ throw an error
+                if datasets_to_upload != existing_datasets:
                     return error(
                         f"Study {s.name} already exists but its datasets differ from the already uploaded: Please check"
                     )
@@ -1121,11 +1291,10 @@ def upload(
                 # the study hasn't passed the validation
                 continue
             # upload the study
-            upload_study(
-                study_tree, url, headers, certfile, certpwd, chunk_size, IP_ADDR
-            )
+            upload_study(study_tree, url, session, chunk_size, IP_ADDR)
     except (
         RequestMethodError,
+        requests.RequestException,
         ResourceCreationException,
         ResourceRetrievingException,
         ResourceAssignationException,
@@ -17,7 +17,8 @@ setup(
     install_requires=[
         "python-dateutil",
         "pytz",
-        "requests>=2.6.1",
+        "requests>=2.16.0",
+        "urllib3>=1.21.1",
         "typer[all]==0.4.0",
         "click==8.0.1",
         "pyOpenSSL",
@@ -0,0 +1,222 @@
+import json
+from datetime import date
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+import requests
+
+from nig import upload
+
+CHUNK_SIZE = 1000
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(upload.time, "sleep", lambda seconds: None)
+
+
+def write(path: Path, text: str) -> Path:
+    path.write_text(text)
+    return path
+
+
+@pytest.mark.parametrize("chunks", [upload.read_chunks, upload.map_chunks])
+@pytest.mark.parametrize(
+    "size",
+    [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 5 * CHUNK_SIZE + 7, 5000],
+)
+def test_chunks(tmp_path: Path, chunks: Any, size: int) -> None:
+    content = bytes(i % 251 for i in range(size))
+    file = tmp_path / "data.fastq.gz"
+    file.write_bytes(content)
+
+    with open(file, "rb") as f:
+        # the chunks have to be copied before asking for the next one
+        data = [bytes(chunk) for chunk in chunks(f, CHUNK_SIZE)]
+
+    assert b"".join(data) == content
+    assert all(len(chunk) == CHUNK_SIZE for chunk in data[:-1])
+    assert all(data)
+
+
+class FakeSession:
+    """Session whose responses, or errors, are taken from a list"""
+
+    def __init__(self, results: List[Any]) -> None:
+        self.results = results
+        self.calls = 0
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        result = self.results[min(self.calls, len(self.results) - 1)]
+        self.calls += 1
+        if isinstance(result, Exception):
+            raise result
+        r = requests.Response()
+        r.status_code = result
+        r._content = b"response"
+        return r
+
+
+def upload_file(tmp_path: Path, session: FakeSession, size: int = 10) -> bool:
+    file = tmp_path / "data.fastq.gz"
+    file.write_bytes(b"x" * size)
+    return upload.upload_file(
+        file,
+        size,
+        "https://server/api/dataset/uuid/files/upload",
+        session,  # type: ignore[arg-type]
+        1,
+        "1.2.3.4",
+        lambda n: None,
+    )
+
+
+def test_request_retries_connection_errors() -> None:
+    session = FakeSession([requests.ConnectionError("refused")])
+    with pytest.raises(requests.ConnectionError):
+        upload.put(url="https://server", session=session, data=b"")
+    assert session.calls == 3
+
+
+def test_request_does_not_resend_after_read_timeout() -> None:
+    session = FakeSession([requests.ReadTimeout("timeout"), 200])
+    with pytest.raises(requests.ReadTimeout):
+        upload.put(url="https://server", session=session, data=b"")
+    assert session.calls == 1
+
+
+def test_request_retries_get_after_read_timeout() -> None:
+    session = FakeSession([requests.ReadTimeout("timeout"), 200])
+    r = upload.get(url="https://server", session=session, data={})
+    assert r.status_code == 200
+    assert session.calls == 2
+
+
+def test_upload_file(tmp_path: Path) -> None:
+    session = FakeSession([503, 503, 200])
+    assert upload_file(tmp_path, session)
+    assert session.calls == 3
+
+
+def test_upload_file_unavailable_server(tmp_path: Path) -> None:
+    session = FakeSession([503])
+    with pytest.raises(upload.UploadException):
+        upload_file(tmp_path, session)
+    # first attempt and 5 resends
+    assert session.calls == 6
+
+
+def test_upload_file_network_errors(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(upload, "get_ip", lambda: "1.2.3.4")
+    session = FakeSession([requests.ConnectionError("refused")])
+    with pytest.raises(upload.UploadException):
+        upload_file(tmp_path, session)
+    # request() makes 3 attempts for the first try and each of the 5 resends
+    assert session.calls == 3 * 6
+
+
+def test_upload_file_ip_changed(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(upload, "get_ip", lambda: "5.6.7.8")
+    session = FakeSession([requests.ConnectionError("refused")])
+    assert not upload_file(tmp_path, session)
+    assert session.calls == 3
+
+
+def test_upload_file_read_timeout(tmp_path: Path) -> None:
+    session = FakeSession([requests.ReadTimeout("timeout"), 200])
+    with pytest.raises(requests.ReadTimeout):
+        upload_file(tmp_path, session)
+    assert session.calls == 1
+
+
+def test_upload_empty_file(tmp_path: Path) -> None:
+    session = FakeSession([200])
+    with pytest.raises(upload.UploadException):
+        upload_file(tmp_path, session, size=0)
+    assert session.calls == 0
+
+
+DATASETS = {name: [Path(f"{name}.fastq.gz")] for name in ("D1", "D2", "D3")}
+
+
+def test_parse_file_ped(tmp_path: Path) -> None:
+    pedigree = write(
+        tmp_path / "pedigree.txt",
+        "#FamilyID\tIndividualID\tFather\tMother\tSex\tHPO\tAge\tBirthPlace\n"
+        "F1\tD1\tD2\tD3\tM\tHP:0001,HP:0002\t30\tRome\n"
+        "F1\tD2\t-\t-\tM\t-\tN/A\t-\n"
+        "F1\tD3\t-\t-\tF\tHP:0003\t52\t\n",
+    )
+    phenotypes, relationships = upload.parse_file_ped(pedigree, DATASETS)
+
+    # HPO lists are sent as JSON, the separators don't matter
+    hpo = {p["name"]: json.loads(p.pop("hpo")) for p in phenotypes if "hpo" in p}
+    assert hpo == {"D1": ["HP:0001", "HP:0002"], "D3": ["HP:0003"]}
+    assert phenotypes == [
+        {"name": "D1", "sex": "male", "age": 30, "birth_place_name": "Rome"},
+        {"name": "D2", "sex": "male"},
+        {"name": "D3", "sex": "female", "age": 52},
+    ]
+    assert relationships == {"D1": ["D2", "D3"]}
+
+
+def test_parse_file_ped_errors(tmp_path: Path) -> None:
+    header = "#FamilyID\tIndividualID\tFather\tMother\tSex\tHPO\n"
+    pedigree = write(tmp_path / "pedigree.txt", header + "F1\tD1\tD9\t-\tM\t-\n")
+    with pytest.raises(
+        upload.RelationshipException,
+        match="Error in relationship between D1 and D9: Phenotype D9 does not exist",
+    ):
+        upload.parse_file_ped(pedigree, DATASETS)
+
+    pedigree = write(tmp_path / "pedigree.txt", header + "F1\tD1\t-\t-\tM\tHP:12a\n")
+    with pytest.raises(upload.HPOException, match="HP:12a is an invalid HPO"):
+        upload.parse_file_ped(pedigree, DATASETS)
+
+
+def test_parse_file_tech(tmp_path: Path) -> None:
+    technical = write(
+        tmp_path / "technical.txt",
+        "#Name\tDate\tPlatform\tKit\tDataset\n"
+        "T1\t22/09/2017\tIllumina\tkit1\tD1\n"
+        "T2\t2017-09-23\tIon\tkit2\tD2,D3\n",
+    )
+    assert upload.parse_file_tech(technical, DATASETS) == [
+        {
+            "properties": {
+                "name": "T1",
+                "sequencing_date": date(2017, 9, 22),
+                "platform": "Illumina",
+                "enrichment_kit": "kit1",
+            },
+            "datasets": ["D1"],
+        },
+        {
+            "properties": {
+                "name": "T2",
+                "sequencing_date": date(2017, 9, 23),
+                "platform": "Ion",
+                "enrichment_kit": "kit2",
+            },
+            "datasets": ["D2", "D3"],
+        },
+    ]
+
+
+def test_parse_file_tech_unknown_platform(tmp_path: Path) -> None:
+    technical = write(
+        tmp_path / "technical.txt",
+        "#Name\tDate\tPlatform\tKit\tDataset\nT1\t22/09/2017\tNanopore\tkit1\tD1\n",
+    )
+    # the platforms are listed in their documented order
+    with pytest.raises(
+        upload.UnknownPlatformException,
+        match=r"one of \['Illumina', 'Ion', 'Pacific Biosciences', 'Roche 454', "
+        r"'SOLiD', 'SNP-array', 'Other'\]$",
+    ):
+        upload.parse_file_tech(technical, DATASETS)